@@ -1,38 +1,98 @@
 #!/usr/bin/env python3
 """keep_exporter command line interface module. Provides the actual user interactions to `export.py`."""
+import json
+import logging
+import os
 import pathlib
-from typing import Any, Optional, Union
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Optional, Set, Tuple, Union
 
 import click
 import click_config_file
 import gkeepapi
-from configobj import ConfigObj
 from keep_exporter.export import (
-    LocalNote,
-    build_markdown,
+    all_note_media,
     build_note_unique_path,
-    delete_local_only_files,
-    download_media,
+    configure_media_session,
+    delete_local_only_media,
+    delete_local_only_notes,
+    export_note,
     index_existing_files,
+    record_unchanged_notes,
     try_rename_note,
-    write_note,
 )
 
 __version__ = "2.0.1"
 __author__ = "Nathan Beals, Matthew Bafford"
 
 APP_NAME = "Keep Exporter"
+# the app dir path itself is the config file, keep the cached token next to it
+TOKEN_CACHE_FILE = pathlib.Path(click.get_app_dir(APP_NAME) + ".token")
+
+logger = logging.getLogger(__name__)
+
+
+def load_cached_token(user_email: str) -> Optional[str]:
+    """Reads the master token cached by a previous password login.
+
+    Args:
+        user_email (str): user's google email address, a token cached for another user is ignored
+
+    Returns:
+        Optional[str]: the cached master token, or None if there isn't a usable one
+    """
+    try:
+        cached = json.loads(TOKEN_CACHE_FILE.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+
+    if not isinstance(cached, dict) or cached.get("user") != user_email:
+        return None
+
+    return cached.get("token")
+
+
+def save_cached_token(user_email: str, token: str) -> bool:
+    """Atomically writes the master token to the token cache, readable only by the current user.
+
+    Args:
+        user_email (str): user's google email address
+        token (str): master token to cache
+
+    Returns:
+        bool: whether the token was written
+    """
+    try:
+        TOKEN_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        # NamedTemporaryFile creates the file with 0o600 permissions
+        with tempfile.NamedTemporaryFile(
+            "w", dir=TOKEN_CACHE_FILE.parent, encoding="utf-8", delete=False
+        ) as file_handle:
+            json.dump({"user": user_email, "token": token}, file_handle)
+        os.replace(file_handle.name, TOKEN_CACHE_FILE)
+    except OSError as ex:
+        click.echo(f"Unable to cache login token: {str(ex)}", err=True)
+        return False
+
+    return True
 
 
 def login(
-    user_email: str, password: Optional[str], token: Optional[str] = None
+    user_email: str,
+    password: Optional[str],
+    token: Optional[str] = None,
+    cache_token: bool = True,
 ) -> gkeepapi.Keep:
     """Logs in with the given email and password or token.
 
+    When no token is given, a token cached by a previous password login is tried before the password.
+
     Args:
         user_email (str): user's google email address
         password (Optional[str]): account password, either this or `token` are *required*
         token (Optional[str], optional): account token, either this or `password` are **required**. Defaults to None.
+        cache_token (bool, optional): use and update the token cache. Defaults to True.
 
     Raises:
         click.BadParameter: Login failed
@@ -50,11 +110,26 @@ def login(
         except gkeepapi.exception.LoginException as ex:
             raise click.BadParameter(f"Token login (resume) failed: {str(ex)}")
 
+    cached_token = load_cached_token(user_email) if cache_token else None
+    if cached_token:
+        try:
+            click.echo("Logging in with cached token")
+            keep.resume(user_email, cached_token)
+
+            return keep
+        except gkeepapi.exception.LoginException as ex:
+            click.echo(f"Cached token login (resume) failed: {str(ex)}", err=True)
+            if not password:
+                password = click.prompt("Password", hide_input=True)
+
     if password:
         try:
             click.echo("Logging in with password")
             keep.login(user_email, password)
 
+            if cache_token:
+                save_cached_token(user_email, keep.getMasterToken())
+
             return keep
         except gkeepapi.exception.LoginException as ex:
             raise click.BadParameter(f"Password login failed: {str(ex)}")
@@ -89,8 +164,8 @@ def token_callback_password_or_token(
     value: Any,
 ) -> Any:
     """
-    On the token param (after password), ensure that either a password
-    or token were supplied, and if neither was, prompt for the password.
+    On the token param (after password), ensure that either a password,
+    token or cached token were supplied, and if none was, prompt for the password.
     """
     if value:
         token = value
@@ -99,6 +174,11 @@ def token_callback_password_or_token(
     password = get_click_supplied_value(ctx, "password")
 
     if not token and not password:
+        cache_token = get_click_supplied_value(ctx, "cache_token")
+        user = get_click_supplied_value(ctx, "user")
+        if cache_token is not False and user and load_cached_token(user):
+            return None
+
         click.echo("Neither password nor token provided. Prompting for password")
         password = click.prompt("Password", hide_input=True)
         ctx.params["password"] = password
@@ -166,6 +246,12 @@ def date_format_handler(
     help="Google account password (prompt if empty). Either this or token is required.",
     hide_input=True,
 )
+@click.option(  # must come before --token, which checks for a cached token
+    "--cache-token/--no-cache-token",
+    default=True,
+    show_default=True,
+    help="Cache the login token after a password login, and try the cached token before the password next time.",
+)
 @click.option(
     "--token",
     "-t",
@@ -222,17 +308,34 @@ def date_format_handler(
     show_default=True,
     help="Skip existing media if it appears unchanged from the local copy.",
 )
+@click.option(
+    "--workers",
+    default=5,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of notes to download and write at once.",
+)
+@click.option(
+    "--verbose/--no-verbose",
+    "-v",
+    default=False,
+    show_default=True,
+    help="Print the progress of every note and media file.",
+)
 def main(
     ctx,
     directory: str,
     user: str,
     password: Optional[str],
     token: Optional[str],
+    cache_token: bool,
     header: bool,
     delete_local: bool,
     rename_local: bool,
     date_format: str,
     skip_existing_media: bool,
+    workers: int,
+    verbose: bool,
     # iso8601: Any,
     # config: str,  # required to be here, despite being as-of-yet unused.
     **_kwargs,
@@ -243,11 +346,15 @@ def main(
     if ctx.invoked_subcommand is not None:
         return False
 
+    # only keep_exporter's own loggers are made verbose, not gkeepapi's request logging
+    logging.basicConfig(format="%(message)s")
+    logging.getLogger("keep_exporter").setLevel(
+        logging.DEBUG if verbose else logging.INFO
+    )
+
     click.echo(f"Notes directory: {notepath}")
     click.echo(f"Media directory: {mediapath}")
 
-    keep = login(user, password, token)
-
     if not notepath.exists():
         click.echo("Notes directory does not exist, creating.")
         notepath.mkdir(parents=True)
@@ -256,52 +363,125 @@ def main(
         click.echo("Media directory does not exist, creating.")
         mediapath.mkdir(parents=True)
 
-    click.echo("Indexing local files.")
-    local_index = index_existing_files(notepath)
+    # gkeepapi pulls every note from the server while logging in, index the local
+    # files in the background so the disk walk overlaps with that network sync
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        click.echo("Indexing local files.")
+        local_index_future = executor.submit(index_existing_files, notepath)
+
+        keep = login(user, password, token, cache_token)
+        configure_media_session(keep)
+
+        local_index = local_index_future.result()
 
     click.echo("Indexing remote notes.")
-    keep_notes = dict([(note.id, note) for note in keep.all()])
+    keep_notes = {note.id: note for note in keep.all()}
 
-    skipped_notes, updated_notes, new_notes = 0, 0, 0
+    skipped_notes, updated_notes, new_notes, failed_notes = 0, 0, 0, 0
     downloaded_media = 0
-    deleted_notes, deleted_media = delete_local_only_files(
-        local_index, keep_notes, delete_local
-    )
+    deleted_notes = delete_local_only_notes(local_index, keep_notes, delete_local)
+
+    # target paths are assigned serially so filename de-duplication stays deterministic,
+    # only the download and write of each note runs concurrently
+    taken_names: Set[str] = {name.casefold() for name in os.listdir(notepath)}
+    pending_notes = []
+    # (note ID, media ID) of every note's media, skipped or not, for local-only media cleanup
+    keep_media: Set[Tuple[str, str]] = set()
 
     for note in keep_notes.values():  # type: gkeepapi._node.Note
+        keep_media.update((note.id, media.id) for media in all_note_media(note))
+
         local_note = local_index.get(note.id)
         if not local_note:
-            click.echo(f"Downloading new note {note.id}")
-            new_notes += 1
+            logger.debug("Downloading new note %s", note.id)
 
-        target_path = build_note_unique_path(notepath, note, date_format, local_index)
+        local_path = local_note.path if local_note else None
+        if local_path and not rename_local:
+            # the note keeps its existing file, so there's no need to build its canonical name
+            target_path = local_path
+        else:
+            target_path = build_note_unique_path(
+                notepath, note, date_format, local_index, taken_names
+            )
 
-        local_path = local_index.get(note.id, LocalNote(note.id)).path
-        if local_path:
-            if rename_local and local_path != target_path:
-                target_path = try_rename_note(local_index[note.id], target_path)
-            else:
-                target_path = local_path
+            if local_path and local_path != target_path:
+                target_path = try_rename_note(local_note, target_path)
+                if target_path != local_path and local_path.parent == notepath:
+                    taken_names.discard(local_path.name.casefold())
+
+        # notes kept in a subdirectory don't take up a name in notepath itself
+        if target_path.parent == notepath:
+            taken_names.add(target_path.name.casefold())
 
         # decide to skip after the rename (due to date format change) has a chance
         if local_note:
-            if local_note.timestamp_updated == note.timestamps.updated:
+            if (
+                local_note.timestamp_updated
+                and local_note.timestamp_updated >= note.timestamps.updated
+            ):
                 skipped_notes += 1
                 continue
             else:
-                updated_notes += 1
-                click.echo(f"Updating existing file for note {note.id}")
-
-        images, downloaded = download_media(keep, note, mediapath, skip_existing_media)
-        markdown = build_markdown(note, images)
-
-        downloaded_media += downloaded
-
-        write_note(target_path, header, note, markdown)
+                logger.debug("Updating existing file for note %s", note.id)
+
+        pending_notes.append(
+            (note, target_path, local_note.content_hash if local_note else None)
+        )
+
+    # existing notes whose content didn't change, only their updated timestamp
+    unchanged_notes = []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                export_note,
+                keep,
+                note,
+                target_path,
+                mediapath,
+                header,
+                skip_existing_media,
+                previous_hash,
+            ): (note, target_path, previous_hash)
+            for note, target_path, previous_hash in pending_notes
+        }
+
+        with click.progressbar(
+            as_completed(futures),
+            length=len(futures),
+            label="Exporting notes",
+        ) as completed:
+            for future in completed:
+                note, target_path, previous_hash = futures[future]
+                try:
+                    written, downloaded = future.result()
+                # pylint: disable=broad-except
+                except Exception as ex:
+                    # one note failing to export shouldn't take the rest of the sync down with it
+                    failed_notes += 1
+                    click.echo(f"Unable to export note {note.id}: {str(ex)}", err=True)
+                    continue
+
+                downloaded_media += downloaded
+
+                if note.id not in local_index:
+                    new_notes += 1
+                    continue
+
+                if written:
+                    updated_notes += 1
+                else:
+                    skipped_notes += 1
+                    unchanged_notes.append((target_path, note, previous_hash))
+
+    if unchanged_notes:
+        record_unchanged_notes(notepath, unchanged_notes)
+
+    deleted_media = delete_local_only_media(local_index, keep_media, delete_local)
 
     click.echo("Finished syncing.")
     click.echo(
-        f"Notes: {skipped_notes} unchanged, {updated_notes} updated, {new_notes} new, {deleted_notes} deleted"
+        f"Notes: {skipped_notes} unchanged, {updated_notes} updated, {new_notes} new, {deleted_notes} deleted, {failed_notes} failed"
     )
     click.echo(f"Media: {downloaded_media} downloaded, {deleted_media} deleted")
 
@@ -309,26 +489,25 @@ def main(
 @main.command()
 @click.pass_context
 def savetoken(ctx):
-    """Saves the master token to your configuration file. Avoids re-logging in every time an export happens."""
+    """Saves the master token to the token cache. Avoids re-logging in every time an export happens."""
     user, password, _token = (
         ctx.parent.params.get("user", ""),
         ctx.parent.params.get("password", ""),
         ctx.parent.params.get("token", ""),
     )
 
-    keep = login(user, password)
-    click.echo("Saving master token.")
-
-    config_file = ctx.parent.params.get("config", None)
-
-    if config_file:
-        config_obj = ConfigObj(config_file, unrepr=True)
+    # the cache is what savetoken writes, so log in with the password, never the cached token
+    if not password:
+        password = click.prompt("Password", hide_input=True)
 
-        if keep.getMasterToken() != config_obj.get("token", ""):
-            config_obj["token"] = keep.getMasterToken()
-            config_obj.write()
+    keep = login(user, password, cache_token=False)
+    click.echo("Saving master token.")
 
-            click.echo("Master token written to configuration file.")
+    master_token = keep.getMasterToken()
+    if master_token == load_cached_token(user):
+        click.echo(f"Master token is already saved in {TOKEN_CACHE_FILE}.")
+    elif save_cached_token(user, master_token):
+        click.echo(f"Master token written to {TOKEN_CACHE_FILE}.")
 
 
 if __name__ == "__main__":
@@ -2,20 +2,113 @@
 """Library functions that do the heavy lifting of this package."""
 # pylint: disable=protected-access
 import datetime
+import email.utils
+import hashlib
+import json
+import logging
 import mimetypes
+import os
 import pathlib
-from typing import Dict, List, NamedTuple, Optional, Set, Tuple, Union, ValuesView
+import re
+import shutil
+import tempfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 import click
 
 # import click_config_file
-import frontmatter
 import gkeepapi
+import requests
+import yaml
 from gkeepapi.node import NodeAudio, NodeDrawing, NodeImage
-from mdutils.mdutils import MdUtils
-from pathvalidate import sanitize_filename
+from requests.adapters import HTTPAdapter, Retry
+
+# libyaml's C bindings parse and emit several times faster, but are an optional part of PyYAML
+try:
+    from yaml import CSafeDumper as SafeDumper
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeDumper, SafeLoader
+
+# per-note and per-media progress from worker threads, only shown with --verbose
+logger = logging.getLogger(__name__)
+
+# extensions of the mimetypes keep serves media as, looking these up doesn't need the mimetypes
+# database, which is read from disk the first time it's used
+MEDIA_EXTENSIONS = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+    "audio/3gpp": ".3gp",
+}
+
+# media downloads are network bound, fetch this many blobs at once
+MEDIA_WORKERS = 8
+# connections kept alive to the media host, must be at least MEDIA_WORKERS
+MEDIA_POOL_SIZE = 32
+# transient server errors and rate limiting (429) are retried with exponential backoff, waiting as
+# long as the server asks to when it sends Retry-After. once retries run out the last response is
+# handed back rather than raised, so fetch_media only gives up on that one blob
+MEDIA_RETRY = Retry(
+    total=5,
+    backoff_factor=0.3,
+    status_forcelist=[429, 500, 502, 503, 504],
+    respect_retry_after_header=True,
+    raise_on_status=False,
+)
+# media is streamed to disk in chunks of this size, rather than held in memory whole
+MEDIA_CHUNK_SIZE = 1 << 20
+
+_media_executor = ThreadPoolExecutor(
+    max_workers=MEDIA_WORKERS, thread_name_prefix="keep-media"
+)
+
+# keep's list item checkboxes and the markdown task list items they're exported as
+CHECKBOX_MARKDOWN = {"☑ ": "- [X] ", "☐ ": "- [ ] "}
+CHECKBOX_RE = re.compile("|".join(CHECKBOX_MARKDOWN))
+
+# note headers are read by this many threads at once while indexing
+INDEX_WORKERS = 8
 
-mimetypes.add_type("audio/3gpp", ".3gp")
+# parsed frontmatter of indexed notes, re-used while a note file's mtime and size are unchanged
+INDEX_CACHE_FILENAME = ".keep_exporter_state.json"
+INDEX_CACHE_VERSION = 1
+
+# media directories created this run, so each is only mkdir'd once
+_media_dirs: Set[pathlib.Path] = set()
+
+# strftime re-parses its format string on every call, the default and --iso8601 formats are built directly
+DATE_FORMATTERS: Dict[str, Callable[[datetime.datetime], str]] = {
+    "%Y-%m-%d": lambda date: f"{date.year:04d}-{date.month:02d}-{date.day:02d}",
+    "%Y-%m-%dT%H:%M:%S": lambda date: (
+        f"{date.year:04d}-{date.month:02d}-{date.day:02d}"
+        f"T{date.hour:02d}:{date.minute:02d}:{date.second:02d}"
+    ),
+}
+
+
+# sanitize_filename is deterministic, so note filenames can be cached across notes and retries
+@lru_cache(maxsize=8192)
+def _sanitize_filename(filename: str, max_len: int) -> str:
+    # pathvalidate is only imported once a note is named, not for --help or savetoken
+    # pylint: disable=import-outside-toplevel
+    from pathvalidate import sanitize_filename
+
+    return sanitize_filename(filename, max_len=max_len)
 
 
 def all_note_media(
@@ -26,7 +119,174 @@ def all_note_media(
     Currently NodeDrawing, NodeImage, and NodeMedia.
     There are other blob types, but they don't seem actionable as media.
     """
-    return note.images + note.drawings + note.audio
+    return [*note.images, *note.drawings, *note.audio]
+
+
+def configure_media_session(keep: gkeepapi.Keep) -> None:
+    """Mounts a larger connection pool on the session used to fetch media, so concurrent downloads
+    re-use kept-alive connections instead of opening a new one per blob, and retries failed requests.
+
+    Args:
+        keep (gkeepapi.Keep): logged in keep instance
+    """
+    adapter = HTTPAdapter(
+        pool_connections=MEDIA_POOL_SIZE,
+        pool_maxsize=MEDIA_POOL_SIZE,
+        max_retries=MEDIA_RETRY,
+    )
+    keep._media_api._session.mount("https://", adapter)
+
+
+@lru_cache(maxsize=32)
+def guess_extension(mimetype: str) -> Optional[str]:
+    """Extension for a media mimetype, from `MEDIA_EXTENSIONS` or else mimetypes.guess_extension,
+    cached since media only comes in a handful of mimetypes."""
+    extension = MEDIA_EXTENSIONS.get(mimetype)
+    if extension:
+        return extension
+
+    extension = mimetypes.guess_extension(mimetype)
+
+    # .jpe just feels weird, but it's my default in testing
+    if extension == ".jpe":
+        return ".jpg"
+
+    return extension
+
+
+def build_etag_path(media_file: pathlib.Path) -> pathlib.Path:
+    """Builds the path of the sidecar file holding a media file's ETag.
+    It's hidden, so the indexer doesn't mistake it for another media file."""
+    return media_file.with_name(f".{media_file.name}.etag")
+
+
+def fetch_media(
+    keep: gkeepapi.Keep,
+    note: gkeepapi._node.Note,
+    media: Union[NodeImage, NodeDrawing, NodeAudio],
+    media_type: str,
+    media_file: pathlib.Path,
+    skip_existing: bool,
+) -> int:
+    """Downloads a single media blob to disk, unless it's already there and unchanged.
+
+    Args:
+        keep (gkeepapi.Keep): keep instance
+        note (gkeepapi._node.Note): note the media belongs to
+        media (Union[NodeImage, NodeDrawing, NodeAudio]): media blob to download
+        media_type (str): blob type as reported by keep, only used for output
+        media_file (pathlib.Path): path to write the media to
+        skip_existing (bool): skip existing media?
+
+    Returns:
+        int: 1 if the media was downloaded, 0 if it was skipped
+    """
+    headers = {}
+    local_size = None
+    etag_file = build_etag_path(media_file)
+
+    local_stat = None
+    if skip_existing:
+        try:
+            local_stat = os.stat(media_file)
+        except FileNotFoundError:
+            pass
+
+    if local_stat is not None:
+        local_size = local_stat.st_size
+
+        # checking size isn't perfect, and drawings don't have a size,
+        # but it doesn't seem right to always re-download images that likely
+        # haven't changed
+        if local_size == getattr(media.blob, "byte_size", None):
+            logger.debug(
+                "Media file %s exists and is same size as in Google Keep. Skipping.",
+                media_file,
+            )
+            return 0
+
+        # otherwise let the server tell us whether it changed since we wrote the local copy
+        headers["If-Modified-Since"] = email.utils.formatdate(
+            local_stat.st_mtime, usegmt=True
+        )
+        try:
+            headers["If-None-Match"] = etag_file.read_text(encoding="utf-8").strip()
+        except OSError:
+            pass
+
+    try:
+        url = keep._media_api.get(media)
+        with keep._media_api._session.get(
+            url, headers=headers, stream=True
+        ) as response:
+            # an error page (e.g. an expired media URL) must never replace the local copy
+            if response.status_code != 304 and not 200 <= response.status_code < 300:
+                click.echo(
+                    f"Unable to download media {media.id} for note {note.id}: HTTP {response.status_code}",
+                    err=True,
+                )
+                return 0
+
+            # only headers have been read at this point, the body is skipped if unchanged
+            if response.status_code == 304 or (
+                local_size is not None
+                and response.headers.get("Content-Length") == str(local_size)
+            ):
+                logger.debug(
+                    "Media file %s is unchanged in Google Keep. Skipping.", media_file
+                )
+                return 0
+
+            logger.debug(
+                "Downloading media %s %s for note %s", media_type, media.id, note.id
+            )
+
+            # write to a temporary file first, so an interrupted download never leaves a truncated media file
+            # it's hidden, so one left behind by a killed run isn't indexed as media
+            partial_file = media_file.with_name(f".{media_file.name}.part")
+            response.raw.decode_content = True
+            try:
+                with partial_file.open("wb") as file_handle:
+                    shutil.copyfileobj(response.raw, file_handle, MEDIA_CHUNK_SIZE)
+                os.replace(partial_file, media_file)
+            except BaseException:
+                if partial_file.exists():
+                    partial_file.unlink()
+                raise
+
+            etag = response.headers.get("ETag")
+            if etag:
+                etag_file.write_text(etag, encoding="utf-8")
+            elif etag_file.exists():
+                etag_file.unlink()
+    except requests.RequestException as ex:
+        # connection errors, and retries used up on errors, cost this one file, not the whole export
+        click.echo(
+            f"Unable to download media {media.id} for note {note.id}: {str(ex)}",
+            err=True,
+        )
+        return 0
+
+    return 1
+
+
+def build_note_media_path(mediapath: pathlib.Path, note_id: str) -> pathlib.Path:
+    """Builds the folder a note's media is kept in.
+
+    Media files are nested under folders named by the note's ID, which simplifies figuring out the
+    note media files came from. Those folders are sharded by a 2 character hex prefix of the ID's hash,
+    so no single directory grows past a few hundred entries.
+
+    Args:
+        mediapath (pathlib.Path): root media path
+        note_id (str): note's google keep ID
+
+    Returns:
+        pathlib.Path: folder for the note's media
+    """
+    shard = hashlib.blake2b(note_id.encode(), digest_size=1).hexdigest()
+
+    return mediapath / shard / note_id
 
 
 def download_media(
@@ -35,7 +295,7 @@ def download_media(
     mediapath: pathlib.Path,
     skip_existing: bool,
 ) -> Tuple[List[pathlib.Path], int]:
-    """Downloads media files from keep
+    """Downloads media files from keep, fetching up to `MEDIA_WORKERS` blobs concurrently
 
     Args:
         keep (gkeepapi.Keep): keep instance
@@ -51,73 +311,74 @@ def download_media(
     if not note_media:
         return ([], 0)
 
-    ret = []
-    downloaded_media = 0
+    note_media_path = build_note_media_path(mediapath, note.id)
+    if note_media_path not in _media_dirs:
+        note_media_path.mkdir(parents=True, exist_ok=True)
+        _media_dirs.add(note_media_path)
+
+    # media used to be stored unsharded, directly under mediapath
+    legacy_media_path = mediapath / note.id
+
+    work = []
 
     for media in note_media:
         meta = media.blob.save()
         # ocr = meta["extracted_text"]  # TODO save ocr as metadata? in markdown or image?
 
         if meta.get("type", "") == "DRAWING":
-            extension = mimetypes.guess_extension(
+            extension = guess_extension(
                 meta.get("drawingInfo", {})
                 .get("snapshotData", {})
                 .get("mimetype", "image/png")
             )  # All drawings seem to be pngs
         elif meta.get("type") == "IMAGE":
-            extension = mimetypes.guess_extension(meta.get("mimetype", "image/jpeg"))
-            # .jpe just feels weird, but it's my default in testing
-            if extension == ".jpe":
-                extension = ".jpg"
+            extension = guess_extension(meta.get("mimetype", "image/jpeg"))
         else:  # 'AUDIO'
-            extension = mimetypes.guess_extension(meta.get("mimetype", "audio/3gpp"))
-
-        # nest media files under folders named by the note's ID
-        # this simplifies figuring out the note media files came from
-        note_media_path = mediapath / note.id
-        note_media_path.mkdir(exist_ok=True)
+            extension = guess_extension(meta.get("mimetype", "audio/3gpp"))
 
-        media_file = (
-            note_media_path / f"{sanitize_filename(media.id,max_len=135)}{extension}"
-        )
+        # media ids are opaque keep ids, already safe to use as-is, just like note ids
+        media_filename = f"{media.id}{extension}"
+        media_file = note_media_path / media_filename
 
-        # checking size isn't perfect, and drawings don't have a size,
-        # but it doesn't seem right to always re-download images that likely
-        # haven't changed
-        if (
-            skip_existing
-            and media_file.exists()
-            and hasattr(media.blob, "byte_size")
-            and media_file.stat().st_size == media.blob.byte_size
-        ):
-            click.echo(
-                f"Media file f{media_file} exists and is same size as in Google Keep. Skipping."
-            )
-        else:
-            print(f"Downloading media {meta.get('type')} {media.id} for note {note.id}")
+        legacy_media_file = legacy_media_path / media_filename
+        if not media_file.exists() and legacy_media_file.exists():
+            legacy_media_file.rename(media_file)
 
-            url = keep._media_api.get(media)
-            media_data = keep._media_api._session.get(url)
-            with media_file.open("wb") as file_handle:
-                file_handle.write(media_data.content)
+        work.append((media, meta.get("type"), media_file))
 
-            downloaded_media += 1
+    # drop the legacy folder once it's empty, so mediapath only holds the shards,
+    # rmdir fails and leaves it alone while it still has (e.g. local-only) files in it
+    try:
+        legacy_media_path.rmdir()
+    except OSError:
+        pass
 
-        ret.append(media_file)
+    # executor.map yields results in submission order, regardless of which download finishes first
+    downloaded = _media_executor.map(
+        lambda item: fetch_media(keep, note, *item, skip_existing), work
+    )
+    downloaded_media = sum(downloaded)
 
-    return (ret, downloaded_media)
+    return ([media_file for _, _, media_file in work], downloaded_media)
 
 
-def build_frontmatter(note: gkeepapi._node.Note, markdown: str) -> frontmatter.Post:
+def build_frontmatter(note: gkeepapi._node.Note) -> Dict[str, Any]:
     """Builds the frontmatter header put at the top of notes
 
     Args:
         note (gkeepapi._node.Note): Note to build header from
-        markdown (str): markdown body
 
     Returns:
-        frontmatter.Post: Completed header + body
+        Dict[str, Any]: header metadata, in the order it's written
     """
+    timestamps = note.timestamps
+    # gkeepapi appears to be treating "0" as a timestamp rather than null.
+    # Sometimes the data structure does not have the key at all instead of 0.
+    optional_timestamps = (
+        ("trashed", timestamps.trashed),
+        ("deleted", timestamps.deleted),
+    )
+
     metadata = {
         "title": note.title,
         "url": note.url,
@@ -128,9 +389,14 @@ def build_frontmatter(note: gkeepapi._node.Note, markdown: str) -> frontmatter.P
         "tags": [label.name for label in note.labels.all()],
         "color": note.color.name,
         "timestamps": {
-            "created": note.timestamps.created.timestamp(),
-            "edited": note.timestamps.edited.timestamp(),
-            "updated": note.timestamps.updated.timestamp(),
+            "created": timestamps.created.timestamp(),
+            "edited": timestamps.edited.timestamp(),
+            "updated": timestamps.updated.timestamp(),
+            **{
+                name: timestamp.timestamp()
+                for name, timestamp in optional_timestamps
+                if timestamp and timestamp.year > 1970
+            },
         },
         "google_keep_id": note.id,
         "type": note.type.name,
@@ -138,14 +404,7 @@ def build_frontmatter(note: gkeepapi._node.Note, markdown: str) -> frontmatter.P
         "sort": note.sort,
     }
 
-    # gkeepapi appears to be treating "0" as a timestamp rather than null.
-    # Sometimes the data structure does not have the key at all instead of 0.
-    if note.timestamps.trashed and note.timestamps.trashed.year > 1970:
-        metadata["timestamps"]["trashed"] = note.timestamps.trashed.timestamp()
-    if note.timestamps.deleted and note.timestamps.deleted.year > 1970:
-        metadata["timestamps"]["deleted"] = note.timestamps.deleted.timestamp()
-
-    return frontmatter.Post(markdown, handler=None, **metadata)
+    return metadata
 
 
 def build_markdown(note: gkeepapi._node.Note, images: List[pathlib.Path]) -> str:
@@ -153,55 +412,128 @@ def build_markdown(note: gkeepapi._node.Note, images: List[pathlib.Path]) -> str
 
     Args:
         note (gkeepapi._node.Note): Note to build body out of
-        images (List[pathlib.Path]): Images embedded in body
+        images (List[pathlib.Path]): Images embedded in body, relative to the note
 
     Returns:
         str: string representation of the body contents
     """
-    doc = MdUtils(
-        ""
-    )  # mdutils requires a string file name. We're not using it to write files, ignore it.
-
-    doc.new_header(1, note.title)
-    doc.new_header(2, "Note")
-
-    text = note.text
-    text = text.replace("☑ ", "- [X] ")
-    text = text.replace("☐ ", "- [ ] ")
+    # one pass over the text for both checkbox states
+    text = CHECKBOX_RE.sub(lambda match: CHECKBOX_MARKDOWN[match.group(0)], note.text)
 
-    doc.new_paragraph(text)
+    parts = ["# ", note.title, "\n\n## Note\n\n", text, "\n"]
 
     if note.annotations.links:
-        doc.new_line()
-        doc.new_line()
-        doc.new_header(2, "Links")
-        doc.new_list(
-            [
-                doc.new_inline_link(link=link.url, text=link.title)
-                for link in note.annotations.links
-            ]
+        parts.append("\n## Links\n\n")
+        parts.extend(
+            f"- [{link.title}]({link.url})\n" for link in note.annotations.links
         )
 
     if images:
-        doc.new_line()
-        doc.new_header(2, "Attached Media")
+        parts.append("\n## Attached Media\n\n")
+        parts.extend(f"![]({image.as_posix()})\n" for image in images)
 
-        for image in images:
-            doc.new_line(doc.new_inline_image("", image.name))
+    return "".join(parts)
 
-    return doc.file_data_text
 
+def build_content_hash(metadata: Dict[str, Any], markdown: str) -> str:
+    """Hashes a note's body and metadata, ignoring timestamps, which change without the content changing.
 
-def write_note(target_path, header, note, markdown):
-    """Writes built notes to disk, optionally builds a header/frontmatter too."""
-    with target_path.open("wb+") as file_handle:
-        if header:
-            front_matter = build_frontmatter(note, markdown)
-            frontmatter.dump(
-                front_matter, file_handle, sort_keys=False
-            )  # don't sort frontmatter keys
-        else:
-            file_handle.write(markdown.encode("utf-8"))
+    Args:
+        metadata (Dict[str, Any]): frontmatter header to hash
+        markdown (str): markdown body to hash
+
+    Returns:
+        str: hex digest of the note content
+    """
+    metadata = {
+        key: value
+        for key, value in metadata.items()
+        if key not in ("timestamps", "content_hash")
+    }
+
+    content_hash = hashlib.blake2b(digest_size=16)
+    content_hash.update(markdown.encode("utf-8"))
+    content_hash.update(json.dumps(metadata, sort_keys=True, default=str).encode())
+
+    return content_hash.hexdigest()
+
+
+def write_note(target_path, header, note, markdown, previous_hash=None) -> bool:
+    """Writes built notes to disk, optionally builds a header/frontmatter too.
+
+    With a header, the content hash is stored in it, and the write is skipped when it matches `previous_hash`.
+
+    Returns:
+        bool: whether the note was written
+    """
+    if header:
+        metadata = build_frontmatter(note)
+        content_hash = build_content_hash(metadata, markdown)
+        if content_hash == previous_hash:
+            return False
+
+        metadata["content_hash"] = content_hash
+
+    payload = markdown.encode("utf-8")
+    if header:
+        # --- delimited YAML header, the envelope python-frontmatter and most markdown tools expect
+        front_matter_yaml = yaml.dump(
+            metadata,
+            Dumper=SafeDumper,
+            encoding="utf-8",
+            allow_unicode=True,
+            default_flow_style=False,
+            sort_keys=False,  # don't sort frontmatter keys
+        )
+        payload = b"".join((b"---\n", front_matter_yaml, b"---\n\n", payload))
+
+    # written to a hidden temporary file and swapped in, so an interrupted write never truncates a note
+    partial_path = target_path.with_name(f".{target_path.name}.tmp")
+    partial_path.write_bytes(payload)
+    os.replace(partial_path, target_path)
+
+    return True
+
+
+def export_note(
+    keep: gkeepapi.Keep,
+    note: gkeepapi._node.Note,
+    target_path: pathlib.Path,
+    mediapath: pathlib.Path,
+    header: bool,
+    skip_existing_media: bool,
+    previous_hash: Optional[str] = None,
+) -> Tuple[bool, int]:
+    """Downloads a note's media and writes the note to disk. Independent of every other note, so
+    it's safe to run concurrently as long as each note has its own `target_path`.
+
+    Args:
+        keep (gkeepapi.Keep): keep instance
+        note (gkeepapi._node.Note): note to export
+        target_path (pathlib.Path): path to write the note to
+        mediapath (pathlib.Path): path to put media
+        header (bool): include the frontmatter header?
+        skip_existing_media (bool): skip existing media?
+        previous_hash (Optional[str], optional): content hash of the local copy. Defaults to None.
+
+    Returns:
+        Tuple[bool, int]: whether the note file was written, and the number of media files downloaded
+    """
+    media_files, downloaded = download_media(keep, note, mediapath, skip_existing_media)
+    # link media relative to the note, so the links survive moving the export directory
+    images = [
+        pathlib.Path(os.path.relpath(media_file, target_path.parent))
+        for media_file in media_files
+    ]
+    markdown = build_markdown(note, images)
+
+    written = write_note(target_path, header, note, markdown, previous_hash)
+    if not written:
+        logger.debug(
+            "Note %s content is unchanged, not rewriting %s", note.id, target_path
+        )
+
+    return (written, downloaded)
 
 
 LocalMedia = NamedTuple(
@@ -221,10 +553,12 @@ class LocalNote:
         path: Optional[pathlib.Path] = None,
         timestamp_updated: Optional[datetime.datetime] = None,
         local_media: Dict[str, LocalMedia] = None,
+        content_hash: Optional[str] = None,
     ):
         self.google_keep_id = google_keep_id
         self.path = path
         self.timestamp_updated = timestamp_updated
+        self.content_hash = content_hash
 
         if not local_media:
             self.local_media: Dict[str, LocalMedia] = {}
@@ -232,6 +566,142 @@ class LocalNote:
             self.local_media = local_media
 
 
+def walk_files(directory: pathlib.Path) -> Iterator[os.DirEntry]:
+    """
+    Recursively yields every file under `directory`, without following symlinked directories.
+    Uses os.scandir so the file type comes from the directory listing instead of a stat() per entry.
+    Hidden files and directories (.git, the index cache, etc) are never part of an export and are skipped.
+    """
+    stack = [os.fspath(directory)]
+
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file():
+                    yield entry
+
+
+def read_frontmatter_metadata(path: str) -> Dict[str, Any]:
+    """
+    Reads only the leading `---` delimited YAML block of a markdown file and parses it,
+    the (potentially much larger) note body after it is never read.
+    Returns an empty dict for files without a frontmatter header.
+    """
+    with open(path, "rb") as file_handle:
+        if file_handle.readline().rstrip() != b"---":
+            return {}
+
+        header_lines = []
+        for line in file_handle:
+            if line.rstrip() == b"---":
+                break
+            header_lines.append(line)
+        else:  # never closed, not a frontmatter header
+            return {}
+
+    metadata = yaml.load(b"".join(header_lines), Loader=SafeLoader)
+
+    return metadata if isinstance(metadata, dict) else {}
+
+
+def load_index_cache(directory: pathlib.Path) -> Dict[str, Dict[str, Any]]:
+    """
+    Loads the index cache written by the previous run, keyed by note file path relative to `directory`.
+    Returns an empty cache if it doesn't exist, can't be read or is from another version.
+    """
+    try:
+        cache = json.loads((directory / INDEX_CACHE_FILENAME).read_bytes())
+    except (OSError, ValueError):
+        return {}
+
+    if not isinstance(cache, dict) or cache.get("version") != INDEX_CACHE_VERSION:
+        return {}
+
+    files = cache.get("files")
+    if not isinstance(files, dict):
+        return {}
+
+    # malformed entries are dropped, so those notes' headers are simply re-read
+    return {
+        path: entry
+        for path, entry in files.items()
+        if isinstance(entry, dict) and isinstance(entry.get("metadata"), dict)
+    }
+
+
+def save_index_cache(directory: pathlib.Path, files: Dict[str, Dict[str, Any]]) -> None:
+    """Atomically writes the index cache, failing to write it only costs re-parsing notes next run."""
+    cache_file = directory / INDEX_CACHE_FILENAME
+
+    try:
+        with tempfile.NamedTemporaryFile(
+            "w",
+            dir=directory,
+            prefix=INDEX_CACHE_FILENAME,
+            encoding="utf-8",
+            delete=False,
+        ) as file_handle:
+            json.dump(
+                {"version": INDEX_CACHE_VERSION, "files": files},
+                file_handle,
+                default=str,
+            )
+        os.replace(file_handle.name, cache_file)
+    except OSError as ex:
+        click.echo(f"Unable to write index cache {cache_file}: {str(ex)}", err=True)
+
+
+def read_index_metadata(path: str) -> Dict[str, Any]:
+    """Reads the parts of a note's frontmatter the index uses, which is also all that gets cached."""
+    metadata = read_frontmatter_metadata(path)
+
+    return {
+        "google_keep_id": metadata.get("google_keep_id"),
+        "timestamps": {
+            "updated": metadata.get("timestamps", {}).get("updated"),
+        },
+        "content_hash": metadata.get("content_hash"),
+    }
+
+
+def record_unchanged_notes(
+    directory: pathlib.Path,
+    notes: List[Tuple[pathlib.Path, gkeepapi._node.Note, str]],
+) -> None:
+    """
+    Records the new updated timestamp of notes whose content hash was unchanged in the index cache.
+    Their files weren't rewritten, so without this the stale timestamp in their header would have
+    them exported again on every run.
+
+    Args:
+        directory (pathlib.Path): notes directory the index cache is in
+        notes (List[Tuple[pathlib.Path, gkeepapi._node.Note, str]]): (note file, note, content hash)
+    """
+    cache = load_index_cache(directory)
+
+    for path, note, content_hash in notes:
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+
+        cache[os.path.relpath(path, directory)] = {
+            "signature": [stat.st_mtime_ns, stat.st_size],
+            "metadata": {
+                "google_keep_id": note.id,
+                "timestamps": {"updated": note.timestamps.updated.timestamp()},
+                "content_hash": content_hash,
+            },
+        }
+
+    save_index_cache(directory, cache)
+
+
 def index_existing_files(directory: pathlib.Path) -> Dict[str, LocalNote]:
     """
     Scans the output folder looking for existing markdown files
@@ -246,57 +716,83 @@ def index_existing_files(directory: pathlib.Path) -> Dict[str, LocalNote]:
     errors = 0
     media = 0
 
-    for file in directory.rglob("*"):
-        if not file.is_file():
-            continue
+    cache = load_index_cache(directory)
+    fresh_cache: Dict[str, Dict[str, Any]] = {}
+
+    # (path, relative path, signature, metadata or the Future reading it)
+    note_files: List[Tuple[str, str, List[int], Any]] = []
+
+    # headers not in the cache are read on a thread pool while the walk continues,
+    # then added to the index in walk order, so the same file always wins a duplicate ID
+    with ThreadPoolExecutor(max_workers=INDEX_WORKERS) as executor:
+        for entry in walk_files(directory):
+            # markdown file
+            if entry.name.endswith(".md"):
+                relative_path = os.path.relpath(entry.path, directory)
+                stat = entry.stat()
+                signature = [stat.st_mtime_ns, stat.st_size]
+
+                cached = cache.get(relative_path)
+                if cached and cached.get("signature") == signature:
+                    metadata = cached["metadata"]
+                else:
+                    metadata = executor.submit(read_index_metadata, entry.path)
+
+                note_files.append((entry.path, relative_path, signature, metadata))
+
+            # media file
+            else:
+                media += 1
+
+                file = pathlib.Path(entry.path)
+                google_keep_id = file.parent.name
+                # media files are named {media id}{extension}
+                media_id = file.stem
+
+                index.setdefault(google_keep_id, LocalNote(google_keep_id))
+                index[google_keep_id].local_media[media_id] = LocalMedia(
+                    file, google_keep_id, media_id
+                )
 
-        # markdown file
-        if file.name.endswith(".md"):
+    for path, relative_path, signature, metadata in note_files:
+        if isinstance(metadata, Future):
             try:
-                with file.open("rt") as file_handle:
-                    note_frontmatter = frontmatter.load(file_handle)
-
-                    google_keep_id: str = note_frontmatter.metadata.get("google_keep_id")
-                    if google_keep_id:
-                        if google_keep_id in index and index[google_keep_id].path:
-                            click.echo(
-                                f"Same Google Keep ID {google_keep_id} in multiple files:\n"
-                                f"    {file}\n"
-                                f"    {index[google_keep_id].path}\n"
-                                f"Only the last file will be updated."
-                            )
-
-                        keep_notes += 1
-                        index.setdefault(google_keep_id, LocalNote(google_keep_id))
-
-                        updated: datetime.datetime = datetime.datetime.fromtimestamp(
-                            note_frontmatter.metadata.get("timestamps", {}).get("updated")
-                        )
-
-                        index[google_keep_id].timestamp_updated = updated
-                        index[google_keep_id].path = file
-                    else:
-                        unknown_notes += 1
-
-            except IOError as ex:
-                errors = 0
+                metadata = metadata.result()
+            except (IOError, yaml.YAMLError) as ex:
+                errors += 1
                 click.echo(
-                    f"Unable to open Markdown file {file}. Skipping: {str(ex)}",
+                    f"Unable to read Markdown file {path}. Skipping: {str(ex)}",
                     err=True,
                 )
+                continue
 
-        # media file
-        else:
-            media += 1
+        fresh_cache[relative_path] = {"signature": signature, "metadata": metadata}
 
-            google_keep_id = file.parent.name
-            media_id = ".".join(file.name.split(".")[0:2])
+        google_keep_id: str = metadata.get("google_keep_id")
+        if google_keep_id:
+            if google_keep_id in index and index[google_keep_id].path:
+                click.echo(
+                    f"Same Google Keep ID {google_keep_id} in multiple files:\n"
+                    f"    {path}\n"
+                    f"    {index[google_keep_id].path}\n"
+                    f"Only the last file will be updated."
+                )
 
+            keep_notes += 1
             index.setdefault(google_keep_id, LocalNote(google_keep_id))
-            index[google_keep_id].local_media[media_id] = LocalMedia(
-                file, google_keep_id, media_id
+
+            updated: datetime.datetime = datetime.datetime.fromtimestamp(
+                metadata.get("timestamps", {}).get("updated")
             )
 
+            index[google_keep_id].timestamp_updated = updated
+            index[google_keep_id].content_hash = metadata.get("content_hash")
+            index[google_keep_id].path = pathlib.Path(path)
+        else:
+            unknown_notes += 1
+
+    save_index_cache(directory, fresh_cache)
+
     click.echo(
         f"Indexed local files: {keep_notes} Google Keep notes, {unknown_notes} unknown markdown files, {media} media files, {errors} errors"
     )
@@ -324,19 +820,35 @@ def try_rename_note(note: LocalNote, target_file: pathlib.Path) -> pathlib.Path:
         return note.path
 
 
+def format_date(date: datetime.datetime, date_format: str) -> str:
+    """Formats `date` like date.strftime(date_format), without strftime for the common formats."""
+    formatter = DATE_FORMATTERS.get(date_format)
+    if formatter:
+        return formatter(date)
+
+    return date.strftime(date_format)
+
+
 def build_note_unique_path(
     notepath: pathlib.Path,
     note: gkeepapi._node.Note,
     date_format: str,
     local_index: Dict[str, LocalNote],
+    taken_names: Set[str],
 ) -> pathlib.Path:
-
+    """
+    Builds the canonical filename for a note, de-duplicated against `taken_names`:
+    the casefolded names of the files in `notepath` and of paths already handed out
+    to other notes this run. Checking the set instead of the filesystem costs no stat() calls,
+    casefolding keeps case-insensitive filesystems from treating two notes' files as one.
+    """
     title = note.title.strip()
     if len(title) < 1:
         title = "untitled"
 
-    date_str = note.timestamps.created.strftime(date_format)
-    filename = f'{sanitize_filename(f"{date_str} - " + title,max_len=135)}.md'
+    date_str = format_date(note.timestamps.created, date_format)
+    base_filename = _sanitize_filename(f"{date_str} - {title}", max_len=135)
+    filename = f"{base_filename}.md"
     target_path = notepath / filename
 
     local_note = local_index.get(note.id)
@@ -350,7 +862,7 @@ def build_note_unique_path(
         # if re-naming would result in having to de-dupe the target filename, keep the
         # exising filename - initial pass at fixing this just resulted in bouncing between
         # two different filenames each pass
-        if target_path.exists():
+        if filename.casefold() in taken_names:
             click.echo(
                 f"Note {note.id} will not be renamed. Target file [{target_path}] exists."
             )
@@ -359,26 +871,26 @@ def build_note_unique_path(
     # otherwise, if the file already exists avoid overwriting it
     # put the unique note ID and an incrementing index at the end of the filename
     dedupe_index = 1
-    while target_path.exists():
-        filename = f'{sanitize_filename(f"{date_str} - " + title,max_len=135)}.{note.id}.{dedupe_index}.md'
-        target_path = notepath / filename
+    while filename.casefold() in taken_names:
+        filename = f"{base_filename}.{note.id}.{dedupe_index}.md"
         dedupe_index += 1
 
-    return target_path
+    return notepath / filename
 
 
-def delete_local_only_files(
+def delete_local_only_notes(
     local_index: Dict[str, LocalNote],
-    keep_notes: Dict[str, List[gkeepapi.node.Note]],
+    keep_notes: Dict[str, gkeepapi._node.Note],
     delete_local: bool,
-) -> Tuple[int, int]:
+) -> int:
     """
-    Checks the local index for any notes or media that exist only locally
+    Checks the local index for any notes that exist only locally
     and were not returned in the Google Keep API call.
     """
-    deleted_notes, deleted_media = 0, 0
+    deleted_notes = 0
 
-    local_only_note_ids = set(local_index.keys()).difference(set(keep_notes.keys()))
+    # dict key views support set operations directly, no need to copy either side into a set
+    local_only_note_ids = local_index.keys() - keep_notes.keys()
 
     if local_only_note_ids:
         if not delete_local:
@@ -398,33 +910,36 @@ def delete_local_only_files(
                     )
                     note_path.unlink()
 
-    local_only_media: Set[Tuple[str, str]] = set(
-        [
-            (local_media.google_keep_note_id, local_media.google_keep_media_id)
-            for local_note in local_index.values()
-            for local_media in local_note.local_media.values()
-            if local_media.google_keep_note_id and local_media.google_keep_media_id
-        ]
-    )
+    return deleted_notes
 
-    notes: ValuesView[gkeepapi._node.Note] = keep_notes.values()
-    keep_media: Set[Tuple[str, str]] = set(
-        [
-            (keep_note.id, keep_media.id)
-            for keep_note in notes
-            for keep_media in all_note_media(keep_note)
-        ]
-    )
 
-    local_only_media_ids = local_only_media.difference(keep_media)
+def delete_local_only_media(
+    local_index: Dict[str, LocalNote],
+    keep_media: Set[Tuple[str, str]],
+    delete_local: bool,
+) -> int:
+    """
+    Checks the local index for any media that exists only locally and isn't in `keep_media`,
+    the (note ID, media ID) pairs of every note the main loop saw in the Google Keep API call.
+    """
+    deleted_media = 0
+
+    local_only_media: Set[Tuple[str, str]] = {
+        (local_media.google_keep_note_id, local_media.google_keep_media_id)
+        for local_note in local_index.values()
+        for local_media in local_note.local_media.values()
+        if local_media.google_keep_note_id and local_media.google_keep_media_id
+    }
+
+    local_only_media_ids = local_only_media - keep_media
     if not local_only_media_ids:
-        return (deleted_notes, 0)
+        return 0
 
     if not delete_local:
         click.echo(
-            f"{len(local_only_note_ids)} media files exist locally, but not in Google Keep. Add argument [--delete-local] to delete."
+            f"{len(local_only_media_ids)} media files exist locally, but not in Google Keep. Add argument [--delete-local] to delete."
         )
-        return (deleted_notes, 0)
+        return 0
 
     for (note_id, media_id) in local_only_media_ids:
         media = local_index[note_id].local_media[media_id]
@@ -433,6 +948,16 @@ def delete_local_only_files(
             f"    Deleting media [{media_id}] for note [{note_id}] file [{media.path}]"
         )
         media.path.unlink()
+
+        etag_file = build_etag_path(media.path)
+        if etag_file.exists():
+            etag_file.unlink()
         deleted_media += 1
 
-    return (deleted_notes, deleted_media)
+        # the note's media folder (sharded or legacy) goes too once its last file is deleted
+        try:
+            media.path.parent.rmdir()
+        except OSError:
+            pass
+
+    return deleted_media